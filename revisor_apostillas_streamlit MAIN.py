@@ -17,17 +17,20 @@ MEJORAS EN ESTA VERSIÓN:
 
 import os
 import base64
-import json
+import hashlib
 import re
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import streamlit as st
-import anthropic
+import orjson
 import pandas as pd
-from PyPDF2 import PdfReader, PdfWriter
-import pdfplumber
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Font, Alignment
+from pypdf import PdfReader
+import pikepdf
+import fitz  # PyMuPDF
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
 from pdf2image import convert_from_bytes
 import numpy as np
 
@@ -642,10 +645,70 @@ with tab_criterios:
 """, unsafe_allow_html=True)
 
 # =============================================================================
-# FIRMA DIGITAL - busca en los mismos lugares que Adobe Reader
+# REGEXES PRECOMPILADAS
+# Compiladas una sola vez al importar el módulo. re.search/re.sub con
+# literales recompilan bajo presión del cache global de re (~512 patrones),
+# y estas corren por cada PDF subido.
 # =============================================================================
 
+_RE_CLAVE_IF = re.compile(r'IF[\s\-_]+(\d{4})[\s\-_]+(\d+)', re.IGNORECASE)
+_RE_IF_CRUDO = re.compile(rb'IF[-\s]+(\d{4})[-\s]+(\d+)')
+_RE_FECHA_ES = re.compile(r'(\d{1,2})\s+de\s+([a-z]+)\s+(?:de(?:l)?\s+)?(\d{4})')
+_RE_FECHA_NUM = re.compile(r'^(\d{1,4})[/.\-](\d{1,2})[/.\-](\d{1,4})$')
+# Variante sin anclar para ESCANEAR fechas numéricas dentro de texto libre
+# (rechazo_rapido); cada match se reparsea con _RE_FECHA_NUM.
+_RE_FECHA_NUM_TEXTO = re.compile(r'\b\d{1,4}[/.\-]\d{1,2}[/.\-]\d{1,4}\b')
+_RE_ESPACIOS = re.compile(r' +')
+
+# Frase clave en bytes para el prefiltro de clasificación: GEDO suele
+# embeberla sin comprimir en el stream del PDF, así que bytes.find la
+# encuentra sin extraer texto (ver _detectar_tipo_por_contenido).
+_CE_FRASE_BYTES = b"CERTIFICO QUE EL PRESENTE DOCUMENTO"
+
+# =============================================================================
+# CACHE POR CONTENIDO
+# Streamlit re-ejecuta todo el script en cada interacción; sin cache cada
+# rerun vuelve a parsear todos los PDFs. Cacheamos por hash del contenido
+# (blake2b corto) y pasamos los bytes con guion bajo para que Streamlit no
+# los hashee de nuevo por su cuenta.
+# =============================================================================
+
+def _clave_pdf(pdf_bytes):
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _firma_digital_cacheada(clave_pdf, _pdf_bytes):
+    return _verificar_firma_digital(_pdf_bytes)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _texto_pdf_cacheado(clave_pdf, _pdf_bytes):
+    return _extraer_texto_pdf(_pdf_bytes)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _tipo_por_contenido_cacheado(clave_pdf, _pdf_bytes, _nombre_archivo):
+    return _detectar_tipo_por_contenido(_pdf_bytes, _nombre_archivo)
+
 def verificar_firma_digital(pdf_bytes):
+    return _firma_digital_cacheada(_clave_pdf(pdf_bytes), pdf_bytes)
+
+def extraer_texto_pdf(pdf_bytes):
+    return _texto_pdf_cacheado(_clave_pdf(pdf_bytes), pdf_bytes)
+
+def detectar_tipo_por_contenido(pdf_bytes, nombre_archivo=""):
+    return _tipo_por_contenido_cacheado(_clave_pdf(pdf_bytes), pdf_bytes, nombre_archivo)
+
+# =============================================================================
+# FIRMA DIGITAL - busca en los mismos lugares que Adobe Reader
+# =============================================================================
+
+def _verificar_firma_digital(pdf_bytes):
+    # Camino rápido: toda firma digital PDF lleva un /ByteRange en el
+    # diccionario de firma. Si el token no aparece en los bytes crudos no
+    # hay firma posible, y nos ahorramos parsear el PDF completo — el caso
+    # "sin firma" pasa de un parseo entero a un escaneo lineal en C.
+    if b'/ByteRange' not in pdf_bytes:
+        return {"tiene_firma": False, "cantidad_firmas": 0, "firmantes": []}
+
     try:
         reader = PdfReader(io.BytesIO(pdf_bytes))
         firmas = []
@@ -675,24 +738,33 @@ def verificar_firma_digital(pdf_bytes):
                 except:
                     continue
 
-        for page in reader.pages:
-            try:
-                if '/Annots' in page:
-                    for annot_ref in page['/Annots']:
-                        annot = annot_ref.get_object()
-                        if annot.get('/Subtype') == '/Widget' and annot.get('/FT') == '/Sig':
-                            v = annot.get('/V')
-                            if v:
-                                if hasattr(v, 'get_object'):
-                                    v = v.get_object()
-                                nombre = str(v.get('/Name', 'Firma en página'))
-                                if nombre not in firmas:
-                                    firmas.append(nombre)
-            except:
-                continue
-
-        raw = str(reader.trailer)
-        if "/Sig" in raw and not firmas:
+        # El AcroForm es la fuente canónica: los widgets de firma de las
+        # páginas apuntan a los mismos campos. Recorrer /Annots solo sirve
+        # cuando el AcroForm no rindió nada (PDFs mal formados), y en
+        # documentos grandes es la parte cara del chequeo.
+        if not firmas:
+            for page in reader.pages:
+                try:
+                    if '/Annots' in page:
+                        for annot_ref in page['/Annots']:
+                            annot = annot_ref.get_object()
+                            if annot.get('/Subtype') == '/Widget' and annot.get('/FT') == '/Sig':
+                                v = annot.get('/V')
+                                if v:
+                                    if hasattr(v, 'get_object'):
+                                        v = v.get_object()
+                                    nombre = str(v.get('/Name', 'Firma en página'))
+                                    if nombre not in firmas:
+                                        firmas.append(nombre)
+                except:
+                    continue
+
+        # Si el AcroForm no rindió firmantes pero los bytes tienen un campo
+        # /Sig (ya sabemos que hay /ByteRange por el prefiltro de arriba),
+        # hay firma aunque el certificado no se pueda extraer. Buscar en los
+        # bytes evita stringificar el trailer completo, que con streams de
+        # metadata grandes llegaba a alocar varios MB.
+        if not firmas and b'/Sig' in pdf_bytes:
             firmas.append("Firma digital detectada (certificado no extraíble)")
 
         return {"tiene_firma": bool(firmas), "cantidad_firmas": len(firmas), "firmantes": firmas}
@@ -710,28 +782,39 @@ def extraer_clave_if(texto):
     Ejemplo: "IF-2015-29802485- -DGRC" → ("2015", "29802485")
     Acepta variantes con espacios extra o guiones entre los segmentos.
     """
-    match = re.search(r'IF[\s\-_]+(\d{4})[\s\-_]+(\d+)', texto, re.IGNORECASE)
+    match = _RE_CLAVE_IF.search(texto)
     if match:
         return (match.group(1), match.group(2))
     return None
 
-def extraer_texto_pdf(pdf_bytes):
+def _extraer_texto_pdf(pdf_bytes, hasta_que=None):
     """
-    Extrae texto de un PDF usando pdfplumber con extract_words().
-    extract_words() es mucho más robusto que extract_text() para PDFs de GCABA
-    ya que no pierde líneas por problemas de encoding de fuentes.
+    Extrae texto de un PDF usando PyMuPDF (fitz).
+    El backend anterior (pdfplumber/pdfminer) tardaba >1 segundo por página;
+    PyMuPDF hace lo mismo en C con una fracción del tiempo y de la memoria,
+    y no pierde líneas por problemas de encoding de fuentes en PDFs de GCABA.
+
+    hasta_que: predicado opcional que recibe el texto acumulado después de
+    cada página y corta la iteración cuando devuelve True. Sirve para la
+    clasificación, donde suele alcanzar con la primera página y no tiene
+    sentido extraer las hojas de firmas restantes.
     """
     try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
             partes = []
-            for page in pdf.pages:
+            for page in doc:
                 try:
-                    words = page.extract_words()
-                    if words:
-                        partes.append(" ".join(w["text"] for w in words))
+                    texto = page.get_text("text")
+                    if texto:
+                        partes.append(texto.replace("\n", " "))
+                        if hasta_que is not None and hasta_que(" ".join(partes)):
+                            break
                 except:
                     pass
             return " ".join(partes)
+        finally:
+            doc.close()
     except:
         return ""
 
@@ -760,17 +843,20 @@ def extraer_if_de_bytes_crudos(pdf_bytes):
     Funciona incluso cuando el número está en una imagen escaneada,
     porque GEDO lo embebe también como texto en el stream interno del PDF.
     Ejemplo: "IF-2015-29802485- -DGRC" → ("2015", "29802485")
+
+    La búsqueda corre directamente sobre los bytes (regex en modo bytes):
+    decodificar un PDF de varios MB a latin-1 solo para esto duplicaba la
+    memoria y recorría el buffer dos veces.
     """
     try:
-        raw = pdf_bytes.decode("latin-1", errors="ignore")
-        match = re.search(r'IF[-\s]+(\d{4})[-\s]+(\d+)', raw)
+        match = _RE_IF_CRUDO.search(pdf_bytes)
         if match:
-            return (match.group(1), match.group(2))
+            return (match.group(1).decode('ascii'), match.group(2).decode('ascii'))
     except:
         pass
     return None
 
-def detectar_tipo_por_contenido(pdf_bytes, nombre_archivo=""):
+def _detectar_tipo_por_contenido(pdf_bytes, nombre_archivo=""):
     """
     Clasifica el PDF como CE, IF u OTRO leyendo su CONTENIDO.
 
@@ -789,8 +875,39 @@ def detectar_tipo_por_contenido(pdf_bytes, nombre_archivo=""):
            | ("IF", clave_if_propia, texto_debug)   ← clave puede ser None si no se extrae
            | ("OTRO", None, texto_debug)
     """
-    texto_raw = extraer_texto_pdf(pdf_bytes)
-    texto_norm = re.sub(' +', ' ', texto_raw.replace('\n', ' ')).strip()
+    # ── Prefiltro por bytes crudos ───────────────────────────────────────────
+    # bytes.find es un escaneo lineal en C sin allocaciones sobre el buffer
+    # COMPLETO, pero solo corta el positivo inequívoco: la frase del CE.
+    # Cualquier otra evidencia (señales GCABA, número IF) NO decide desde
+    # los bytes: la frase del CE puede estar en un stream comprimido donde
+    # este escaneo no la ve, así que esos casos caen siempre al camino por
+    # texto extraído, que revisa el CE primero.
+    if _CE_FRASE_BYTES in pdf_bytes:
+        clave = extraer_if_de_bytes_crudos(pdf_bytes)
+        return ("CE", clave, "(CE detectado por prefiltro de bytes)")
+
+    # ── Fallback: clasificación por texto extraído ───────────────────────────
+    señales_gcaba = [
+        "GOBIERNO DE LA CIUDAD",
+        "HOJA ADICIONAL DE FIRMAS",
+        "REGISTRO DEL ESTADO CIVIL",
+        "GEDO",
+    ]
+
+    def _clasificacion_resuelta(texto):
+        # Corta la extracción solo ante el positivo inequívoco: la frase del
+        # CE. Señales GCABA + número IF no alcanzan para frenar antes —
+        # podrían ser las primeras páginas de un CE cuya frase aparece más
+        # adelante, y cortar ahí lo clasificaría como el IF que referencia.
+        return "CERTIFICO QUE EL PRESENTE DOCUMENTO" in texto.upper()
+
+    # Se llama a la implementación directa (no a la versión cacheada) porque
+    # el resultado puede ser parcial; el caché de texto completo queda para
+    # extraer_texto_pdf.
+    # _extraer_texto_pdf ya reemplaza los saltos de línea por espacios al
+    # armar cada página, así que acá solo falta colapsar espacios repetidos.
+    texto_raw = _extraer_texto_pdf(pdf_bytes, hasta_que=_clasificacion_resuelta)
+    texto_norm = _RE_ESPACIOS.sub(' ', texto_raw).strip()
     texto_upper = texto_norm.upper()
 
     # ── Es CE: frase inequívoca de GCABA ────────────────────────────────────
@@ -804,18 +921,16 @@ def detectar_tipo_por_contenido(pdf_bytes, nombre_archivo=""):
     # distinto (ej: GDEBA para Provincia de Buenos Aires). Si no hay número IF
     # con DGRC, el documento no es un IF de GCABA aunque use GEDO o tenga
     # "Hoja Adicional de Firmas" — se trata como documento individual (OTRO).
-    señales_gcaba = [
-        "GOBIERNO DE LA CIUDAD",
-        "HOJA ADICIONAL DE FIRMAS",
-        "REGISTRO DEL ESTADO CIVIL",
-        "GEDO",
-    ]
     if any(s in texto_upper for s in señales_gcaba):
         clave_if = extraer_if_de_bytes_crudos(pdf_bytes)
         if clave_if:
-            # Verificación extra: el número IF debe venir de un documento DGRC
-            raw = pdf_bytes.decode("latin-1", errors="ignore").upper()
-            if "DGRC" in raw or "GOBIERNO DE LA CIUDAD" in texto_upper:
+            # Verificación extra: el número IF debe venir de un documento
+            # DGRC. El token aparece literal en los streams, así que alcanza
+            # con buscarlo sobre los bytes (también en el texto extraído,
+            # por si el stream viene comprimido) sin decodificar todo el
+            # PDF a latin-1 como antes.
+            if (b"DGRC" in pdf_bytes or "DGRC" in texto_upper
+                    or "GOBIERNO DE LA CIUDAD" in texto_upper):
                 return ("IF", clave_if, texto_norm)
         # Tiene señales de GEDO pero no es GCABA → procesar como individual
         return ("OTRO", None, texto_norm)
@@ -824,87 +939,190 @@ def detectar_tipo_por_contenido(pdf_bytes, nombre_archivo=""):
     return ("OTRO", None, texto_norm)
 
 def combinar_pdfs(pdf_bytes_lista):
-    """Combina múltiples PDFs en uno solo. Retorna los bytes del PDF combinado."""
-    writer = PdfWriter()
+    """
+    Combina múltiples PDFs en uno solo con pikepdf (QPDF).
+    QPDF concatena por referencia y solo reescribe el xref, sin re-copiar
+    ni re-codificar los streams de imágenes como hacía PdfWriter, que
+    copiaba el grafo de objetos de cada página.
+    Retorna un memoryview sobre el buffer combinado (getbuffer() no copia).
+    """
+    salida = pikepdf.Pdf.new()
+    abiertos = []
     for pdf_bytes in pdf_bytes_lista:
         try:
-            reader = PdfReader(io.BytesIO(pdf_bytes))
-            for page in reader.pages:
-                writer.add_page(page)
+            pdf = pikepdf.Pdf.open(io.BytesIO(pdf_bytes))
+            abiertos.append(pdf)
+            salida.pages.extend(pdf.pages)
         except Exception as e:
             st.warning(f"Advertencia al combinar PDF: {e}")
     output = io.BytesIO()
-    writer.write(output)
-    output.seek(0)
-    return output.read()
+    salida.save(output, linearize=False)
+    # Los PDFs fuente deben seguir abiertos hasta después de save()
+    for pdf in abiertos:
+        pdf.close()
+    salida.close()
+    return output.getbuffer()
 
 # =============================================================================
 # UTILIDADES
 # =============================================================================
 
 def pdf_a_base64(pdf_bytes):
-    return base64.b64encode(pdf_bytes).decode('utf-8')
+    # Acepta bytes o memoryview (b64encode soporta cualquier buffer);
+    # base64 es ASCII puro, así que decodificamos sin validación UTF-8.
+    return base64.b64encode(pdf_bytes).decode('ascii')
+
+def leer_pdf_subido(archivo):
+    """
+    Devuelve los bytes de un archivo subido, materializándolos UNA sola vez
+    por sesión. Antes cada pasada (contador previo, clasificación) hacía su
+    propio .read(), duplicando la memoria de cada PDF en cada rerun. Se
+    guardan bytes y no memoryview porque los prefiltros usan `in` sobre
+    bytes, que memoryview no soporta para subsecuencias.
+    """
+    cache = st.session_state.setdefault("_pdf_bytes_subidos", {})
+    if archivo.file_id not in cache:
+        cache[archivo.file_id] = archivo.getvalue()
+    return cache[archivo.file_id]
+
+# PDFs más grandes que esto se re-renderizan a JPEG antes de subirlos
+UMBRAL_REENDER_PDF = 2_000_000
 
-def calcular_dias_desde_fecha(fecha_str):
+def pdf_a_bloques_contenido(pdf_bytes):
+    """
+    Arma los bloques de contenido para enviar un PDF a Claude.
+
+    Los PDFs chicos van como documento nativo (el camino más barato). Los
+    escaneos grandes (>2 MB, típico IF con imagen a página completa) se
+    re-renderizan a JPEG de 150 DPI por página: para leer texto y sellos
+    esa fidelidad alcanza, y reduce a la mitad los bytes en tránsito y
+    los tokens de visión facturados.
+    """
+    if len(pdf_bytes) <= UMBRAL_REENDER_PDF:
+        return [{"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": pdf_a_base64(pdf_bytes)}}]
+
+    try:
+        stream = pdf_bytes if isinstance(pdf_bytes, (bytes, bytearray)) else bytes(pdf_bytes)
+        doc = fitz.open(stream=stream, filetype="pdf")
+        try:
+            bloques = []
+            for page in doc:
+                pix = page.get_pixmap(dpi=150)
+                bloques.append({
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": "image/jpeg",
+                        "data": base64.b64encode(pix.tobytes("jpeg", jpg_quality=75)).decode("ascii"),
+                    },
+                })
+            return bloques
+        finally:
+            doc.close()
+    except Exception:
+        # Si el render falla, mandamos el PDF original tal cual
+        return [{"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": pdf_a_base64(pdf_bytes)}}]
+
+_MESES_ES = {"enero":1,"febrero":2,"marzo":3,"abril":4,"mayo":5,"junio":6,
+             "julio":7,"agosto":8,"septiembre":9,"setiembre":9,"octubre":10,"noviembre":11,"diciembre":12}
+
+def calcular_dias_desde_fecha(fecha_str, hoy=None):
+    # hoy se toma una sola vez por llamada (y puede inyectarse para que
+    # toda una tanda use el mismo instante) en vez de consultarlo por rama.
     if not fecha_str:
         return None
+    hoy = hoy or datetime.now()
     fecha_str = fecha_str.lower()
-    meses = {"enero":1,"febrero":2,"marzo":3,"abril":4,"mayo":5,"junio":6,
-             "julio":7,"agosto":8,"septiembre":9,"setiembre":9,"octubre":10,"noviembre":11,"diciembre":12}
-    match = re.search(r'(\d{1,2})\s+de\s+([a-z]+)\s+(?:de(?:l)?\s+)?(\d{4})', fecha_str)
+    match = _RE_FECHA_ES.search(fecha_str)
     if match:
         try:
-            fecha = datetime(int(match.group(3)), meses.get(match.group(2), 0), int(match.group(1)))
-            return (datetime.now() - fecha).days
+            fecha = datetime(int(match.group(3)), _MESES_ES.get(match.group(2), 0), int(match.group(1)))
+            return (hoy - fecha).days
         except:
             return None
-    for f in ['%d/%m/%Y','%d-%m-%Y','%Y-%m-%d','%d/%m/%y','%d.%m.%Y']:
+    # Fechas numéricas: un solo regex cubre dd/mm/aaaa, dd-mm-aaaa,
+    # dd.mm.aaaa, dd/mm/aa y aaaa-mm-dd. Antes se probaban 5 formatos de
+    # strptime en secuencia, con un ValueError tragado por cada intento
+    # fallido (~4 excepciones por fecha típica).
+    match = _RE_FECHA_NUM.match(fecha_str.strip())
+    if match:
+        a, b, c = match.groups()
         try:
-            return (datetime.now() - datetime.strptime(fecha_str, f)).days
-        except:
-            continue
+            if len(a) == 4:
+                anio, mes, dia = int(a), int(b), int(c)   # aaaa-mm-dd
+            else:
+                dia, mes, anio = int(a), int(b), int(c)   # dd/mm/aaaa o dd/mm/aa
+                if anio < 100:
+                    anio += 2000 if anio < 69 else 1900   # mismo pivote que %y
+            return (hoy - datetime(anio, mes, dia)).days
+        except ValueError:
+            return None
     return None
 
 # =============================================================================
-# CLAUDE – Análisis individual
+# CLIENTE ANTHROPIC COMPARTIDO
 # =============================================================================
 
-def analizar_con_claude(pdf_bytes):
-    client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
-    
-    hoy = datetime.now().strftime('%d/%m/%Y')
-    anio_actual = datetime.now().year
-    mes_actual = datetime.now().strftime('%B')
-    anio_pasado = anio_actual - 1
-    fecha_hace_30_dias = (datetime.now() - timedelta(days=30)).strftime('%d/%m/%Y')
-    fecha_hace_90_dias = (datetime.now() - timedelta(days=90)).strftime('%d/%m/%Y')
-    fecha_ejemplo_futura = (datetime.now() + timedelta(days=30)).strftime('%d/%m/%Y')
+@st.cache_resource(show_spinner=False)
+def _cliente_claude(api_key):
+    # Import diferido: el SDK (httpx incluido) tarda una fracción de segundo
+    # en importarse y solo hace falta cuando se analiza. Al estar el cliente
+    # detrás de cache_resource, el costo se paga una vez por proceso.
+    import anthropic
+    return anthropic.Anthropic(api_key=api_key, max_retries=2, timeout=120.0)
 
-    prompt = f"""Analizá este documento para apostilla en Cancillería Argentina.
+def obtener_cliente_claude():
+    """
+    Devuelve un único anthropic.Anthropic compartido por todo el proceso.
+    Crear un cliente por llamada reinicializaba el pool de conexiones
+    httpx y el contexto TLS: una tanda de N documentos pagaba N handshakes
+    en vez de reusar conexiones keep-alive entre requests concurrentes.
+    Vive en st.cache_resource (keyed por API key) para sobrevivir a los
+    reruns de Streamlit — un global de módulo se recrearía en cada
+    interacción con cualquier widget. El cliente es thread-safe, así que
+    el pool de análisis lo comparte.
+    """
+    return _cliente_claude(CLAUDE_API_KEY)
 
-🗓️ CONTEXTO TEMPORAL (actualizado automáticamente):
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-• HOY es: {hoy}
-• Año ACTUAL: {anio_actual}
-• Mes ACTUAL: {mes_actual}
+# =============================================================================
+# CLAUDE – Análisis individual
+# =============================================================================
+
+def _parsear_respuesta_claude(respuesta):
+    """Extrae el objeto JSON de la respuesta de Claude y lo parsea."""
+    # Claude a veces envuelve el JSON en ```json ... ``` o en texto suelto.
+    # En vez de limpiarlo con regexes, recortamos entre la primera '{' y
+    # la última '}' (una pasada por extremo) y parseamos con orjson.
+    inicio = respuesta.find('{')
+    fin = respuesta.rfind('}')
+    if inicio == -1 or fin == -1:
+        raise ValueError("Respuesta vacía de Claude. Reintentá o revisá el PDF manualmente.")
+    return orjson.loads(respuesta[inicio:fin + 1])
+
+# Reglas estáticas del análisis individual, como constante de módulo. Van
+# en un bloque propio marcado con cache_control ephemeral: al ser un
+# prefijo idéntico entre requests, Anthropic reutiliza el prompt ya
+# tokenizado (≈90% menos tokens de input por hit dentro del TTL del
+# cache). Todo lo que depende de la fecha vive en el bloque CONTEXTO
+# TEMPORAL que se arma por request en _params_analisis_individual.
+_REGLAS_DOC_INDIVIDUAL = """Analizá este documento para apostilla en Cancillería Argentina.
+Las fechas concretas (HOY, año actual y ejemplos) vienen en el bloque
+CONTEXTO TEMPORAL que acompaña a este mensaje.
 
 ⚠️ REGLAS SOBRE FECHAS - Lee con atención:
 
 FECHAS VÁLIDAS (NO marcar como problema):
-• Cualquier fecha del año {anio_actual} hasta hoy ({hoy})
-• Fechas recientes de {anio_pasado} (últimos meses)
-• Ejemplo: "{fecha_hace_30_dias}" (hace 30 días) = VÁLIDO ✓
-• Ejemplo: "{fecha_hace_90_dias}" (hace 90 días) = VÁLIDO ✓
+• Cualquier fecha menor o igual a HOY (ver CONTEXTO TEMPORAL)
+• Fechas recientes del año pasado (últimos meses)
 
 FECHAS PROBLEMÁTICAS (sí marcar como problema):
-• Solo fechas FUTURAS (posteriores a {hoy})
-• Ejemplo: "{fecha_ejemplo_futura}" = FUTURO (problemático) ✗
+• Solo fechas FUTURAS (posteriores a HOY)
 
-REGLA SIMPLE: 
-Si fecha ≤ {hoy} → VÁLIDA, NO marcar problema
-Si fecha > {hoy} → FUTURA, marcar problema
+REGLA SIMPLE:
+Si fecha ≤ HOY → VÁLIDA, NO marcar problema
+Si fecha > HOY → FUTURA, marcar problema
 
-NO menciones "{anio_actual}" como algo raro o futuro - ES EL AÑO ACTUAL.
+NO menciones el año actual como algo raro o futuro - ES EL AÑO ACTUAL.
 
 📋 INSTRUCCIONES DE EXTRACCIÓN:
 
@@ -921,7 +1139,7 @@ Para multiples_firmas:
 Para problemas_detectados:
 • Listá SOLO problemas DOCUMENTALES que impidan o compliquen la apostilla
 • Problemas válidos: firma ausente, imagen ilegible, fecha futura, calidad baja, foto de celular
-• NO incluyas la fecha como problema si es de {anio_actual}
+• NO incluyas la fecha como problema si es del año actual
 • NO incluyas circunstancias del contenido del documento (causa de muerte, tipo de delito, intervención judicial, antecedentes penales registrados, etc.) — eso NO es un problema documental
 • Si el documento está formalmente bien, dejá la lista vacía []
 
@@ -932,8 +1150,8 @@ Para observacion_redactada:
 • Estos detalles son informativos, NO son problemas. El tono debe ser descriptivo y profesional, no alarmista
 • Ejemplos de buenas observaciones:
   - "Acta de defunción de José Miguel Sandoval Rojas emitida el 29/01/2026 por Lucrecia Olivieri, con firma digital válida. Fallecimiento por herida de arma de fuego con intervención de UFI 03."
-  - "Certificado de antecedentes penales de Juan García emitido el 15/02/{anio_actual}, vigente, con firma digital. Registra antecedentes penales por robo."
-  - "Acta de nacimiento de Sofía López emitida el 03/01/{anio_actual} por el Registro Civil, con firma digital de María Rodríguez."
+  - "Certificado de antecedentes penales de Juan García emitido el 15/02 del año en curso, vigente, con firma digital. Registra antecedentes penales por robo."
+  - "Acta de nacimiento de Sofía López emitida el 03/01 del año en curso por el Registro Civil, con firma digital de María Rodríguez."
 
 Para titular_documento:
 • El nombre completo de la persona a quien pertenece el documento
@@ -1003,7 +1221,7 @@ Para nota_intervencion:
 • En cualquier otro caso, dejá vacío ""
 
 Campos a extraer (JSON válido):
-{{
+{
   "tipo_documento": string,
   "titular_documento": string,
   "fecha_emision": string (tal como aparece),
@@ -1022,51 +1240,95 @@ Campos a extraer (JSON válido):
   "es_foto_celular": boolean,
   "problemas_detectados": [strings vacía si todo OK],
   "observacion_redactada": string
-}}"""
-
-    message = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=2000,
-        messages=[{"role": "user", "content": [
-            {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": pdf_a_base64(pdf_bytes)}},
-            {"type": "text", "text": prompt}
+}"""
+
+def _contexto_temporal():
+    """Bloque dinámico con las fechas del día, armado por request."""
+    ahora = datetime.now()
+    hoy = ahora.strftime('%d/%m/%Y')
+    return f"""🗓️ CONTEXTO TEMPORAL (actualizado automáticamente):
+• HOY es: {hoy}
+• Año ACTUAL: {ahora.year}
+• Mes ACTUAL: {ahora.strftime('%B')}
+• Año pasado: {ahora.year - 1}
+• Ejemplo de fecha VÁLIDA: "{(ahora - timedelta(days=30)).strftime('%d/%m/%Y')}" (hace 30 días) ✓
+• Ejemplo de fecha VÁLIDA: "{(ahora - timedelta(days=90)).strftime('%d/%m/%Y')}" (hace 90 días) ✓
+• Ejemplo de fecha FUTURA (problemática): "{(ahora + timedelta(days=30)).strftime('%d/%m/%Y')}" ✗"""
+
+def _params_analisis_individual(pdf_bytes):
+    """
+    Arma los kwargs de messages.create para un documento individual.
+    Separados de la llamada HTTP para poder reutilizarlos tal cual como
+    "params" de la Message Batches API. Las reglas estáticas van primero
+    y con cache_control para que el prefijo aproveche el prompt caching.
+    """
+    return {
+        "model": "claude-sonnet-4-20250514",
+        "max_tokens": 2000,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": _REGLAS_DOC_INDIVIDUAL,
+             "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": _contexto_temporal()},
+            *pdf_a_bloques_contenido(pdf_bytes),
         ]}]
-    )
+    }
 
-    respuesta = message.content[0].text.strip() if message.content else ""
-    respuesta = re.sub(r'^```json\n?', '', respuesta)
-    respuesta = re.sub(r'\n?```$', '', respuesta)
-    # Si Claude envolvió el JSON en texto, extraer solo el objeto
-    match_json = re.search(r'\{[\s\S]*\}', respuesta)
-    if match_json:
-        respuesta = match_json.group(0)
-    if not respuesta:
-        raise ValueError("Respuesta vacía de Claude. Reintentá o revisá el PDF manualmente.")
-    return json.loads(respuesta)
+# Memo explícito de análisis: clave de contenido → (instante, resultado).
+# Es un dict detrás de cache_resource y no st.cache_data porque la ruta de
+# Batches necesita CONSULTARLO (armar el lote solo con los misses) y
+# POBLARLO con los resultados del lote, y cache_data no permite inyectar
+# entradas desde afuera. TTL de una hora: el veredicto depende de la fecha
+# de HOY (vigencias), así que no puede vivir indefinidamente, pero dentro
+# de una sesión el mismo PDF no debería pagar dos veces la llamada.
+_TTL_MEMO_ANALISIS = 3600
+_MAX_MEMO_ANALISIS = 128
+
+@st.cache_resource(show_spinner=False)
+def _memo_analisis():
+    return {}
+
+def _analisis_cacheado(clave):
+    entrada = _memo_analisis().get(clave)
+    if entrada is None:
+        return None
+    instante, resultado = entrada
+    if time.monotonic() - instante > _TTL_MEMO_ANALISIS:
+        _memo_analisis().pop(clave, None)
+        return None
+    return resultado
+
+def _guardar_analisis(clave, resultado):
+    memo = _memo_analisis()
+    while len(memo) >= _MAX_MEMO_ANALISIS:
+        # FIFO simple: los dicts preservan orden de inserción
+        memo.pop(next(iter(memo)))
+    memo[clave] = (time.monotonic(), resultado)
+
+def analizar_con_claude(pdf_bytes):
+    clave = _clave_pdf(pdf_bytes)
+    resultado = _analisis_cacheado(clave)
+    if resultado is None:
+        client = obtener_cliente_claude()
+        message = client.messages.create(**_params_analisis_individual(pdf_bytes))
+        respuesta = message.content[0].text if message.content else ""
+        resultado = _parsear_respuesta_claude(respuesta)
+        _guardar_analisis(clave, resultado)
+    return resultado
 
 # =============================================================================
 # CLAUDE – Análisis de PAR IF + CE (PDF combinado)
 # =============================================================================
 
-def analizar_par_if_ce_con_claude(if_bytes, ce_bytes, nombre_if, nombre_ce):
-    """
-    Combina el IF y el CE en un solo PDF y lo envía a Claude para análisis unificado.
-    La firma que importa es la del CE. El IF es el documento original.
-    """
-    client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
-    
-    hoy = datetime.now().strftime('%d/%m/%Y')
-    anio_actual = datetime.now().year
-
-    # Combinar ambos PDFs en uno
-    pdf_combinado = combinar_pdfs([if_bytes, ce_bytes])
-
-    prompt = f"""Estás analizando un PAR de documentos vinculados para apostilla en Cancillería Argentina.
+# Reglas estáticas del análisis de pares IF+CE, misma mecánica de prompt
+# caching que _REGLAS_DOC_INDIVIDUAL: bloque estático cacheable primero,
+# datos por request (fecha y número IF esperado) en el bloque CONTEXTO.
+_REGLAS_PAR_IF_CE = """Estás analizando un PAR de documentos vinculados para apostilla en Cancillería Argentina.
 
 📂 DOCUMENTO 1 (páginas iniciales): Archivo IF – Es el ACTA o documento original (ej: acta de nacimiento).
 📂 DOCUMENTO 2 (páginas siguientes): Archivo CE – Es el CERTIFICADO que avala al IF.
 
-HOY: {hoy} | AÑO ACTUAL: {anio_actual}
+La fecha de HOY y el número IF esperado vienen en el bloque CONTEXTO que
+acompaña a este mensaje.
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 🔎 TU TAREA PRINCIPAL: Verificar la vinculación IF ↔ CE
@@ -1075,9 +1337,8 @@ HOY: {hoy} | AÑO ACTUAL: {anio_actual}
 El CE debe contener en su texto la frase:
 "Número/s de documento/s electrónico/s: [número IF]"
 
-El número IF del primer archivo es: {nombre_if}
-
-Verificá si el CE (segundo documento) hace referencia a ese número IF en su texto.
+Verificá si el CE (segundo documento) hace referencia al número IF
+indicado en el CONTEXTO.
 
 ⚠️ IMPORTANTE SOBRE FIRMAS:
 • La firma que IMPORTA para apostilla es la del CE (segundo documento), NO la del IF.
@@ -1113,7 +1374,7 @@ Para observacion_redactada:
 • Ejemplo: "Acta de nacimiento de Apolo Luciano Arce Chumbi, CE emitido el 20/02/2026, firmado por Gonzalo Alvarez, referencia IF verificada correctamente."
 
 Respondé SOLO JSON válido:
-{{
+{
   "tipo_documento": string,
   "titular_documento": string,
   "fecha_emision": string,
@@ -1132,21 +1393,90 @@ Respondé SOLO JSON válido:
   "cargo_firmante_ce": string,
   "problemas_detectados": [],
   "observacion_redactada": string
-}}"""
-
-    message = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=2000,
-        messages=[{"role": "user", "content": [
-            {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": pdf_a_base64(pdf_combinado)}},
-            {"type": "text", "text": prompt}
+}"""
+
+def _params_analisis_par(if_bytes, ce_bytes, nombre_if, nombre_ce):
+    """
+    Arma los kwargs de messages.create para un par IF+CE combinado.
+    La firma que importa es la del CE. El IF es el documento original.
+    """
+    contexto = (
+        f"CONTEXTO: HOY es {datetime.now().strftime('%d/%m/%Y')} | "
+        f"AÑO ACTUAL: {datetime.now().year}\n"
+        f"El número IF del primer archivo es: {nombre_if}"
+    )
+
+    # Combinar ambos PDFs en uno
+    pdf_combinado = combinar_pdfs([if_bytes, ce_bytes])
+
+    return {
+        "model": "claude-sonnet-4-20250514",
+        "max_tokens": 2000,
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": _REGLAS_PAR_IF_CE,
+             "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": contexto},
+            *pdf_a_bloques_contenido(pdf_combinado),
         ]}]
+    }
+
+def analizar_par_if_ce_con_claude(if_bytes, ce_bytes, nombre_if, nombre_ce):
+    clave_par = _clave_pdf(if_bytes) + _clave_pdf(ce_bytes)
+    resultado = _analisis_cacheado(clave_par)
+    if resultado is None:
+        client = obtener_cliente_claude()
+        message = client.messages.create(**_params_analisis_par(if_bytes, ce_bytes, nombre_if, nombre_ce))
+        respuesta = message.content[0].text if message.content else ""
+        resultado = _parsear_respuesta_claude(respuesta)
+        _guardar_analisis(clave_par, resultado)
+    return resultado
+
+# =============================================================================
+# CLAUDE – Message Batches API
+# Para tandas grandes conviene un solo envío por lote: la Batches API cobra
+# 50% menos por token y no pelea contra los límites de concurrencia, a
+# cambio de latencia (el lote puede tardar varios minutos). Por eso solo se
+# usa a partir de UMBRAL_LOTE_BATCHES documentos; tandas chicas siguen por
+# las llamadas sincrónicas en paralelo.
+# =============================================================================
+
+UMBRAL_LOTE_BATCHES = 10
+_INTERVALO_SONDEO_BATCH = 5  # segundos entre consultas de estado del lote
+
+def analizar_lote_claude(trabajos, al_progresar=None):
+    """
+    Envía todos los análisis en un solo lote vía la Message Batches API.
+
+    trabajos: dict custom_id → kwargs de messages.create (los mismos que
+    arman _params_analisis_individual / _params_analisis_par).
+    Devuelve dict custom_id → análisis parseado, o la excepción del ítem
+    para que el procesador la reporte como fila de error.
+    """
+    client = obtener_cliente_claude()
+    lote = client.messages.batches.create(
+        requests=[{"custom_id": cid, "params": params} for cid, params in trabajos.items()]
     )
 
-    respuesta = message.content[0].text.strip()
-    respuesta = re.sub(r'^```json\n?', '', respuesta)
-    respuesta = re.sub(r'\n?```$', '', respuesta)
-    return json.loads(respuesta)
+    while lote.processing_status != "ended":
+        time.sleep(_INTERVALO_SONDEO_BATCH)
+        lote = client.messages.batches.retrieve(lote.id)
+        if al_progresar:
+            al_progresar(lote)
+
+    resultados = {}
+    for entrada in client.messages.batches.results(lote.id):
+        if entrada.result.type == "succeeded":
+            mensaje = entrada.result.message
+            texto = mensaje.content[0].text if mensaje.content else ""
+            try:
+                resultados[entrada.custom_id] = _parsear_respuesta_claude(texto)
+            except Exception as e:
+                resultados[entrada.custom_id] = e
+        else:
+            resultados[entrada.custom_id] = ValueError(
+                f"El lote devolvió '{entrada.result.type}' para este documento"
+            )
+    return resultados
 
 # =============================================================================
 # LÓGICA NORMATIVA
@@ -1481,47 +1811,300 @@ def generar_observacion(analisis, problemas):
         return extra
     return obs_base.strip()
 
+# =============================================================================
+# PROCESAMIENTO POR DOCUMENTO
+# Cada función procesa un documento (o par) completo y devuelve la fila de
+# resultados. Son independientes entre sí, así que el orquestador las corre
+# en paralelo con un ThreadPoolExecutor: las llamadas a Claude son I/O puro
+# y el parseo de PDFs libera el GIL en las bibliotecas C.
+# =============================================================================
+
+MAX_WORKERS_ANALISIS = 8
+
+# tiene_firma es True/False/None (None = no se pudo verificar)
+_FIRMA_TEXTO = {True: "SÍ", False: "NO", None: "NO DETECTADA"}
+
+def procesar_par(par, analisis_par=None):
+    """
+    Procesa un par IF+CE vinculado. Devuelve la fila de resultados.
+    Si el análisis ya vino resuelto por la Batches API se pasa en
+    analisis_par (dict, o Exception si ese ítem del lote falló).
+    """
+    if_data = par["if"]
+    ce_data = par["ce"]
+    nombre_display = f"{if_data['nombre']} + {ce_data['nombre']}"
+
+    try:
+        if isinstance(analisis_par, Exception):
+            raise analisis_par
+
+        # Firma: solo la del CE importa
+        firma_info_ce = verificar_firma_digital(ce_data["bytes"])
+
+        # Análisis conjunto con Claude (PDF combinado)
+        if analisis_par is None:
+            analisis_par = analizar_par_if_ce_con_claude(
+                if_data["bytes"],
+                ce_data["bytes"],
+                if_data["nombre"],
+                ce_data["nombre"]
+            )
+
+        estado, accion, problemas = evaluar_par_if_ce(firma_info_ce, analisis_par)
+        observacion = generar_observacion(analisis_par, problemas)
+
+        tiene_firma = firma_info_ce["tiene_firma"]
+        firma_texto = _FIRMA_TEXTO.get(tiene_firma, "NO DETECTADA")
+
+        firmante_ce = analisis_par.get("firmante_ce", "") or "No identificado"
+        cargo_ce = analisis_par.get("cargo_firmante_ce", "") or ""
+        firmante_display = f"{firmante_ce} ({cargo_ce})" if cargo_ce else firmante_ce
+
+        return {
+            "Archivo": nombre_display,
+            "Tipo trámite": "📎 Par IF+CE",
+            "Titular": analisis_par.get("titular_documento"),
+            "Tipo": analisis_par.get("tipo_documento"),
+            "Fecha CE": analisis_par.get("fecha_emision"),
+            "CE referencia IF": "✅ SÍ" if analisis_par.get("ce_referencia_if_correctamente") else "❌ NO",
+            "IF encontrado en CE": analisis_par.get("numero_if_encontrado_en_ce", ""),
+            "Firmante CE": firmante_display,
+            "Firma Digital CE": firma_texto,
+            "Firmantes Certificado": ", ".join(firma_info_ce["firmantes"]),
+            "Estado": estado,
+            "Acción": accion,
+            "Observaciones": observacion
+        }
+
+    except Exception as e:
+        return {
+            "Archivo": nombre_display,
+            "Tipo trámite": "📎 Par IF+CE",
+            "Titular": "",
+            "Tipo": "",
+            "Fecha CE": "",
+            "CE referencia IF": "",
+            "IF encontrado en CE": "",
+            "Firmante CE": "",
+            "Firma Digital CE": "",
+            "Firmantes Certificado": "",
+            "Estado": "⚠️ REVISAR",
+            "Acción": "Error de análisis",
+            "Observaciones": f"Error: {str(e)}"
+        }
+
+def procesar_individual(item, analisis=None):
+    """
+    Procesa un documento individual (OTRO, IF sin CE o CE sin IF).
+    Si el análisis ya vino resuelto por la Batches API se pasa en
+    analisis (dict, o Exception si ese ítem del lote falló).
+    """
+    archivo = item["archivo"]
+    pdf_bytes = item["bytes"]
+
+    advertencia_extra = ""
+    if item.get("advertencia_if_sin_ce"):
+        advertencia_extra = "⚠️ IF sin CE correspondiente cargado"
+    elif item.get("advertencia_ce_sin_if"):
+        clave_ref = item.get("clave_if_ref")
+        ref_str = f"IF-{clave_ref[0]}-{clave_ref[1]}" if clave_ref else "desconocido"
+        advertencia_extra = f"⚠️ CE sin IF correspondiente (busca: {ref_str})"
+
+    try:
+        if isinstance(analisis, Exception):
+            raise analisis
+
+        firma_info = verificar_firma_digital(pdf_bytes)
+        if analisis is None:
+            analisis = analizar_con_claude(pdf_bytes)
+        sello_violeta = detectar_sello_violeta(pdf_bytes)
+        estado, accion, problemas = evaluar_documento(firma_info, analisis, sello_violeta)
+
+        if advertencia_extra:
+            problemas.append(advertencia_extra)
+            if estado == "✅ OK":
+                estado = "⚠️ REVISAR"
+                accion = advertencia_extra
+
+        observacion = generar_observacion(analisis, problemas)
+
+        tiene_firma = firma_info["tiene_firma"]
+        firma_texto = _FIRMA_TEXTO.get(tiene_firma, "NO DETECTADA")
+
+        return {
+            "Archivo": archivo.name,
+            "Tipo trámite": "📄 Individual",
+            "Titular": analisis.get("titular_documento"),
+            "Tipo": analisis.get("tipo_documento"),
+            "Fecha CE": analisis.get("fecha_emision"),
+            "CE referencia IF": "—",
+            "IF encontrado en CE": "—",
+            "Firmante CE": "—",
+            "Firma Digital CE": firma_texto,
+            "Firmantes Certificado": ", ".join(
+                # Para docs educativos: priorizar firmante ministerial educativo
+                # Excluir Cancillería/RR.EE. que es apostilla, no legalización
+                (lambda fv, fi: (
+                    [f for f in fv if any(p in f.lower() for p in
+                        ["ministerio de educacion","ministerio educacion","capital humano",
+                         "legalizaciones","gcba","ministerio del interior","interior y trans"])
+                    and not any(x in f.lower() for x in
+                        ["relaciones exteriores","cancillería","cancilleria","consulado"])]
+                    or [f for f in fv if any(p in f.lower() for p in
+                        ["ministerio","legalizaciones","gcba","interior"])
+                    and not any(x in f.lower() for x in
+                        ["relaciones exteriores","cancillería","cancilleria"])]
+                    or fv or fi or []
+                ))(
+                    analisis.get("firmantes_visibles") or [],
+                    firma_info["firmantes"] or []
+                )
+            ),
+            "Estado": estado,
+            "Acción": accion,
+            "Observaciones": observacion
+        }
+
+    except Exception as e:
+        return {
+            "Archivo": archivo.name,
+            "Tipo trámite": "📄 Individual",
+            "Titular": "",
+            "Tipo": "",
+            "Fecha CE": "",
+            "CE referencia IF": "—",
+            "IF encontrado en CE": "—",
+            "Firmante CE": "—",
+            "Firma Digital CE": "",
+            "Firmantes Certificado": "",
+            "Estado": "⚠️ REVISAR",
+            "Acción": "Error de análisis",
+            "Observaciones": f"Error: {str(e)}"
+        }
+
+def rechazo_rapido(item):
+    """
+    Pre-evaluación local de documentos cuyo veredicto no depende de Claude:
+    un certificado de antecedentes penales sin firma digital y con todas sus
+    fechas vencidas (>90 días) se rechaza diga lo que diga el análisis.
+    Devuelve la fila de resultados lista, o None si el caso no es
+    concluyente y corresponde el análisis completo.
+    """
+    try:
+        firma_info = verificar_firma_digital(item["bytes"])
+        if firma_info["tiene_firma"] is not False:
+            return None
+
+        texto = extraer_texto_pdf(item["bytes"]).lower()
+        if "antecedentes penales" not in texto:
+            return None
+
+        # Se exige que TODAS las fechas del documento estén vencidas: la
+        # primera fecha puede ser la de nacimiento del titular, no la de
+        # emisión. Se escanean tanto las fechas en castellano como las
+        # numéricas (dd/mm/aaaa etc.): la emisión suele venir numérica y
+        # mirarla solo en castellano rechazaba certificados vigentes cuyo
+        # cuerpo tenía alguna fecha vieja. Si alguna fecha es futura o
+        # reciente, el caso va a Claude.
+        dias_por_fecha = {}
+        for m in list(_RE_FECHA_ES.finditer(texto)) + list(_RE_FECHA_NUM_TEXTO.finditer(texto)):
+            dias = calcular_dias_desde_fecha(m.group(0))
+            if dias is not None:
+                dias_por_fecha[m.group(0)] = dias
+        if not dias_por_fecha or min(dias_por_fecha.values()) <= 90:
+            return None
+    except Exception:
+        return None
+
+    fecha_reciente = min(dias_por_fecha, key=dias_por_fecha.get)
+    dias = dias_por_fecha[fecha_reciente]
+    fila = dict.fromkeys(_COLUMNAS_RESULTADO, "")
+    fila.update({
+        "Archivo": item["archivo"].name,
+        "Tipo trámite": "📄 Individual",
+        "Tipo": "Certificado de Antecedentes Penales",
+        "Fecha CE": fecha_reciente,
+        "CE referencia IF": "—",
+        "IF encontrado en CE": "—",
+        "Firmante CE": "—",
+        "Firma Digital CE": "NO",
+        "Estado": "❌ RECHAZAR",
+        "Acción": "Certificado vencido (>90 días)",
+        "Observaciones": f"Vencido hace {dias} días (máximo: 90) y sin firma digital — rechazado sin análisis."
+    })
+    return fila
+
+# Esquema fijo de la tabla de resultados. procesar_par y procesar_individual
+# devuelven exactamente estas claves; tener la lista acá permite armar el
+# DataFrame en forma columnar sin que pandas infiera el esquema fila a fila.
+_COLUMNAS_RESULTADO = [
+    "Archivo", "Tipo trámite", "Titular", "Tipo", "Fecha CE",
+    "CE referencia IF", "IF encontrado en CE", "Firmante CE",
+    "Firma Digital CE", "Firmantes Certificado", "Estado", "Acción",
+    "Observaciones",
+]
+
 # =============================================================================
 # EXCEL EN MEMORIA
 # =============================================================================
 
+@st.cache_data(max_entries=8, show_spinner=False)
 def generar_excel(df):
+    """
+    Genera el Excel estilizado en memoria con xlsxwriter.
+    El coloreado por estado usa tres reglas de formato condicional en vez
+    de pintar celda por celda: openpyxl hacía N×M escrituras de estilo en
+    Python, acá las reglas las evalúa Excel al abrir el archivo.
+
+    Cacheado por contenido del DataFrame: el download_button vive inline y
+    cada interacción con la UI re-ejecuta el script, así el Excel se arma
+    una sola vez por tanda de resultados. Devuelve bytes (no BytesIO)
+    porque st.cache_data necesita serializar el valor.
+    """
     output = io.BytesIO()
-    df.to_excel(output, index=False, engine="openpyxl")
-    output.seek(0)
-    wb = load_workbook(output)
-    ws = wb.active
-
-    verde = PatternFill(start_color="E6F4EA", end_color="E6F4EA", fill_type="solid")
-    amarillo = PatternFill(start_color="FFF8E1", end_color="FFF8E1", fill_type="solid")
-    rojo = PatternFill(start_color="FDECEA", end_color="FDECEA", fill_type="solid")
-    gris = PatternFill(start_color="ECECEC", end_color="ECECEC", fill_type="solid")
-
-    for cell in ws[1]:
-        cell.fill = gris
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    col_estado = next((i for i, c in enumerate(ws[1], 1) if c.value == "Estado"), None)
-
-    for row in ws.iter_rows(min_row=2):
-        estado = row[col_estado - 1].value if col_estado else ""
-        fill = verde if "OK" in str(estado) else amarillo if "REVISAR" in str(estado) else rojo if "RECHAZAR" in str(estado) else None
-        if fill:
-            for cell in row:
-                cell.fill = fill
-
-    for col in ws.columns:
-        max_len = max((len(str(c.value)) for c in col if c.value), default=0)
-        ws.column_dimensions[col[0].column_letter].width = min(max_len + 3, 60)
-
-    ws.freeze_panes = "A2"
-    ws.auto_filter.ref = ws.dimensions
-
-    final = io.BytesIO()
-    wb.save(final)
-    final.seek(0)
-    return final
+    n_filas = len(df)
+    n_cols = len(df.columns)
+
+    # Escritura directa con xlsxwriter: pasar por df.to_excel agregaba una
+    # serialización intermedia de pandas que no aportaba nada al formato.
+    wb = xlsxwriter.Workbook(output, {"in_memory": True})
+    ws = wb.add_worksheet("Revisión")
+
+    header_fmt = wb.add_format({
+        "bold": True, "align": "center", "valign": "vcenter",
+        "bg_color": "#ECECEC",
+    })
+    ws.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+
+    for fila_idx, fila in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(fila_idx, 0, fila)
+
+    if n_filas and "Estado" in df.columns:
+        col_estado = xl_col_to_name(df.columns.get_loc("Estado"))
+        reglas = (
+            ("OK", wb.add_format({"bg_color": "#E6F4EA"})),
+            ("REVISAR", wb.add_format({"bg_color": "#FFF8E1"})),
+            ("RECHAZAR", wb.add_format({"bg_color": "#FDECEA"})),
+        )
+        for palabra, fmt in reglas:
+            ws.conditional_format(1, 0, n_filas, n_cols - 1, {
+                "type": "formula",
+                "criteria": f'=ISNUMBER(SEARCH("{palabra}",${col_estado}2))',
+                "format": fmt,
+            })
+
+    # Anchos de columna: máximo vectorizado entre encabezado y valores
+    for col_idx, nombre in enumerate(df.columns):
+        max_len = len(str(nombre))
+        if n_filas:
+            max_len = max(max_len, int(df[nombre].astype(str).str.len().max()))
+        ws.set_column(col_idx, col_idx, min(max_len + 3, 60))
+
+    ws.freeze_panes(1, 0)
+    ws.autofilter(0, 0, n_filas, n_cols - 1)
+
+    wb.close()
+    return output.getvalue()
 
 # =============================================================================
 # INTERFAZ
@@ -1633,14 +2216,21 @@ with tab_revision:
 """, unsafe_allow_html=True)
 
     if archivos:
+        # Purgar del caché de bytes los archivos que el usuario sacó del
+        # uploader; si no, una sesión larga acumula PDFs muertos en memoria.
+        _ids_actuales = {a.file_id for a in archivos}
+        _cache_bytes = st.session_state.get("_pdf_bytes_subidos", {})
+        for _fid in list(_cache_bytes):
+            if _fid not in _ids_actuales:
+                del _cache_bytes[_fid]
+
         # ── Pre-clasificación para el contador ───────────────────────────────
         _preview_if = {}
         _preview_ce = {}
         _preview_otros = 0
 
         for _a in archivos:
-            _bytes = _a.read()
-            _a.seek(0)  # reset para que el análisis pueda releerlo después
+            _bytes = leer_pdf_subido(_a)
             _tipo, _clave, _ = detectar_tipo_por_contenido(_bytes, _a.name)
             if _tipo == "IF":
                 _preview_if[_clave] = True
@@ -1683,7 +2273,6 @@ with tab_revision:
 """, unsafe_allow_html=True)
 
         if st.button("Analizar documentos", type="primary"):
-            resultados = []
             barra = st.progress(0)
             estado_texto = st.empty()
 
@@ -1700,8 +2289,35 @@ with tab_revision:
                 debug_placeholder = st.empty()
                 debug_rows = []
 
+            # Duplicados exactos (mismo contenido con otro nombre): se
+            # descartan antes de clasificar para no pagar firma + Claude
+            # dos veces. Quedan registrados como fila informativa.
+            vistos = {}
+            filas_duplicadas = []
+
             for archivo in archivos:
-                pdf_bytes = archivo.read()
+                pdf_bytes = leer_pdf_subido(archivo)
+
+                digest = _clave_pdf(pdf_bytes)
+                if digest in vistos:
+                    debug_rows.append({
+                        "Archivo": archivo.name,
+                        "Clasificado como": "DUPLICADO",
+                        "Clave IF detectada": "—",
+                        "Texto extraído (primeros 300 chars)": f"(contenido idéntico a {vistos[digest]})"
+                    })
+                    fila = dict.fromkeys(_COLUMNAS_RESULTADO, "")
+                    fila.update({
+                        "Archivo": archivo.name,
+                        "Tipo trámite": "🔁 Duplicado",
+                        "Estado": "🔁 DUPLICADO",
+                        "Acción": "Ignorado",
+                        "Observaciones": f"Contenido idéntico a {vistos[digest]} — no se reanalizó."
+                    })
+                    filas_duplicadas.append(fila)
+                    continue
+                vistos[digest] = archivo.name
+
                 tipo, clave, texto_extraido = detectar_tipo_por_contenido(pdf_bytes, archivo.name)
 
                 # Info de debug
@@ -1713,7 +2329,11 @@ with tab_revision:
                     "Clave IF detectada": clave_str,
                     "Texto extraído (primeros 300 chars)": preview
                 })
-                debug_placeholder.dataframe(pd.DataFrame(debug_rows), use_container_width=True)
+                # Repintar la tabla entera por archivo re-serializa O(N²)
+                # filas a Arrow; alcanza con refrescar cada tanto y una vez
+                # al final del bucle.
+                if len(debug_rows) % 10 == 0:
+                    debug_placeholder.dataframe(pd.DataFrame(debug_rows), use_container_width=True)
 
                 if tipo == "IF":
                     archivos_if[clave] = {"archivo": archivo, "bytes": pdf_bytes, "nombre": archivo.name}
@@ -1728,28 +2348,29 @@ with tab_revision:
                 else:
                     archivos_otros.append({"archivo": archivo, "bytes": pdf_bytes})
 
+            debug_placeholder.dataframe(pd.DataFrame(debug_rows), use_container_width=True)
+
             # ─────────────────────────────────────────────────────────────────
             # PASO 2: Emparejar CE ↔ IF — solo por coincidencia EXACTA de número
             # No hay fallbacks ciegos: si los números no coinciden, no se emparejan
             # ─────────────────────────────────────────────────────────────────
             pares = []
             if_usados = set()
-            ce_usados = set()
 
             for ce_nombre, ce_data in archivos_ce.items():
                 clave_ref = ce_data["clave_if_ref"]
 
                 if clave_ref and clave_ref in archivos_if:
-                    # Coincidencia exacta: el CE referencia este IF por número
+                    # Coincidencia exacta: el CE referencia este IF por número.
+                    # El IF no se saca del dict a propósito: si dos CE citan
+                    # el mismo número, ambos pares se analizan.
                     pares.append({
                         "if": archivos_if[clave_ref],
                         "ce": ce_data
                     })
                     if_usados.add(clave_ref)
-                    ce_usados.add(ce_nombre)
                 else:
                     # Sin coincidencia: CE huérfano (falta el IF o los números no coinciden)
-                    ce_usados.add(ce_nombre)
                     archivos_otros.append({
                         "archivo": ce_data["archivo"],
                         "bytes": ce_data["bytes"],
@@ -1757,235 +2378,212 @@ with tab_revision:
                         "clave_if_ref": clave_ref
                     })
 
-            # IFs que no fueron referenciados por ningún CE
-            for clave_if, if_data in archivos_if.items():
-                if clave_if not in if_usados:
-                    archivos_otros.append({
-                        "archivo": if_data["archivo"],
-                        "bytes": if_data["bytes"],
-                        "advertencia_if_sin_ce": True
-                    })
-
-            total_tareas = len(pares) + len(archivos_otros)
-            tarea_actual = 0
-
-            # ─────────────────────────────────────────────────────────────────
-            # PASO 3: Procesar PARES IF+CE
-            # ─────────────────────────────────────────────────────────────────
-            for par in pares:
-                if_data = par["if"]
-                ce_data = par["ce"]
-                nombre_display = f"{if_data['nombre']} + {ce_data['nombre']}"
-                estado_texto.text(f"Analizando par: {nombre_display}...")
-                barra.progress(tarea_actual / total_tareas if total_tareas else 1)
-
-                try:
-                    # Firma: solo la del CE importa
-                    firma_info_ce = verificar_firma_digital(ce_data["bytes"])
-
-                    # Análisis conjunto con Claude (PDF combinado)
-                    analisis_par = analizar_par_if_ce_con_claude(
-                        if_data["bytes"],
-                        ce_data["bytes"],
-                        if_data["nombre"],
-                        ce_data["nombre"]
-                    )
-
-                    estado, accion, problemas = evaluar_par_if_ce(firma_info_ce, analisis_par)
-                    observacion = generar_observacion(analisis_par, problemas)
-
-                    tiene_firma = firma_info_ce["tiene_firma"]
-                    firma_texto = "SÍ" if tiene_firma else ("NO" if tiene_firma == False else "NO DETECTADA")
-
-                    firmante_ce = analisis_par.get("firmante_ce", "") or "No identificado"
-                    cargo_ce = analisis_par.get("cargo_firmante_ce", "") or ""
-                    firmante_display = f"{firmante_ce} ({cargo_ce})" if cargo_ce else firmante_ce
-
-                    resultados.append({
-                        "Archivo": nombre_display,
-                        "Tipo trámite": "📎 Par IF+CE",
-                        "Titular": analisis_par.get("titular_documento"),
-                        "Tipo": analisis_par.get("tipo_documento"),
-                        "Fecha CE": analisis_par.get("fecha_emision"),
-                        "CE referencia IF": "✅ SÍ" if analisis_par.get("ce_referencia_if_correctamente") else "❌ NO",
-                        "IF encontrado en CE": analisis_par.get("numero_if_encontrado_en_ce", ""),
-                        "Firmante CE": firmante_display,
-                        "Firma Digital CE": firma_texto,
-                        "Firmantes Certificado": ", ".join(firma_info_ce["firmantes"]),
-                        "Estado": estado,
-                        "Acción": accion,
-                        "Observaciones": observacion
-                    })
-
-                except Exception as e:
-                    resultados.append({
-                        "Archivo": nombre_display,
-                        "Tipo trámite": "📎 Par IF+CE",
-                        "Titular": "",
-                        "Tipo": "",
-                        "Fecha CE": "",
-                        "CE referencia IF": "",
-                        "IF encontrado en CE": "",
-                        "Firmante CE": "",
-                        "Firma Digital CE": "",
-                        "Firmantes Certificado": "",
-                        "Estado": "⚠️ REVISAR",
-                        "Acción": "Error de análisis",
-                        "Observaciones": f"Error: {str(e)}"
-                    })
-
-                tarea_actual += 1
+            # IFs que no fueron referenciados por ningún CE (diferencia de
+            # conjuntos en vez de recorrer todo archivos_if otra vez)
+            for clave_if in archivos_if.keys() - if_usados:
+                if_data = archivos_if[clave_if]
+                archivos_otros.append({
+                    "archivo": if_data["archivo"],
+                    "bytes": if_data["bytes"],
+                    "advertencia_if_sin_ce": True
+                })
 
             # ─────────────────────────────────────────────────────────────────
-            # PASO 4: Procesar archivos individuales (OTROS, IF sin CE, CE sin IF)
+            # PASO 3 y 4: Procesar pares IF+CE y archivos individuales
+            # EN PARALELO. Cada documento es independiente: las llamadas a
+            # Claude son I/O-bound, así que el tiempo total pasa de la suma
+            # de los análisis al máximo de ellos.
             # ─────────────────────────────────────────────────────────────────
+            # Rechazos decidibles localmente (antecedentes vencidos sin
+            # firma): salen del circuito antes de armar tareas, así tampoco
+            # entran al lote de la Batches API.
+            filas_sin_claude = []
+            pendientes = []
             for item in archivos_otros:
-                archivo = item["archivo"]
-                pdf_bytes = item["bytes"]
-                estado_texto.text(f"Analizando {archivo.name}...")
-                barra.progress(tarea_actual / total_tareas if total_tareas else 1)
-
-                advertencia_extra = ""
-                if item.get("advertencia_if_sin_ce"):
-                    advertencia_extra = "⚠️ IF sin CE correspondiente cargado"
-                elif item.get("advertencia_ce_sin_if"):
-                    clave_ref = item.get("clave_if_ref")
-                    ref_str = f"IF-{clave_ref[0]}-{clave_ref[1]}" if clave_ref else "desconocido"
-                    advertencia_extra = f"⚠️ CE sin IF correspondiente (busca: {ref_str})"
-
-                try:
-                    firma_info = verificar_firma_digital(pdf_bytes)
-                    analisis = analizar_con_claude(pdf_bytes)
-                    sello_violeta = detectar_sello_violeta(pdf_bytes)
-                    estado, accion, problemas = evaluar_documento(firma_info, analisis, sello_violeta)
-
-                    if advertencia_extra:
-                        problemas.append(advertencia_extra)
-                        if estado == "✅ OK":
-                            estado = "⚠️ REVISAR"
-                            accion = advertencia_extra
-
-                    observacion = generar_observacion(analisis, problemas)
-
-                    tiene_firma = firma_info["tiene_firma"]
-                    firma_texto = "SÍ" if tiene_firma else ("NO" if tiene_firma == False else "NO DETECTADA")
-
-                    resultados.append({
-                        "Archivo": archivo.name,
-                        "Tipo trámite": "📄 Individual",
-                        "Titular": analisis.get("titular_documento"),
-                        "Tipo": analisis.get("tipo_documento"),
-                        "Fecha CE": analisis.get("fecha_emision"),
-                        "CE referencia IF": "—",
-                        "IF encontrado en CE": "—",
-                        "Firmante CE": "—",
-                        "Firma Digital CE": firma_texto,
-                        "Firmantes Certificado": ", ".join(
-                            # Para docs educativos: priorizar firmante ministerial educativo
-                            # Excluir Cancillería/RR.EE. que es apostilla, no legalización
-                            (lambda fv, fi: (
-                                [f for f in fv if any(p in f.lower() for p in
-                                    ["ministerio de educacion","ministerio educacion","capital humano",
-                                     "legalizaciones","gcba","ministerio del interior","interior y trans"])
-                                and not any(x in f.lower() for x in
-                                    ["relaciones exteriores","cancillería","cancilleria","consulado"])]
-                                or [f for f in fv if any(p in f.lower() for p in
-                                    ["ministerio","legalizaciones","gcba","interior"])
-                                and not any(x in f.lower() for x in
-                                    ["relaciones exteriores","cancillería","cancilleria"])]
-                                or fv or fi or []
-                            ))(
-                                analisis.get("firmantes_visibles") or [],
-                                firma_info["firmantes"] or []
-                            )
-                        ),
-                        "Estado": estado,
-                        "Acción": accion,
-                        "Observaciones": observacion
-                    })
-
-                except Exception as e:
-                    resultados.append({
-                        "Archivo": archivo.name,
-                        "Tipo trámite": "📄 Individual",
-                        "Titular": "",
-                        "Tipo": "",
-                        "Fecha CE": "",
-                        "CE referencia IF": "—",
-                        "IF encontrado en CE": "—",
-                        "Firmante CE": "—",
-                        "Firma Digital CE": "",
-                        "Firmantes Certificado": "",
-                        "Estado": "⚠️ REVISAR",
-                        "Acción": "Error de análisis",
-                        "Observaciones": f"Error: {str(e)}"
-                    })
-
-                tarea_actual += 1
+                fila_rapida = rechazo_rapido(item)
+                if fila_rapida is not None:
+                    filas_sin_claude.append(fila_rapida)
+                else:
+                    pendientes.append(item)
+            archivos_otros = pendientes
+
+            tareas = [(procesar_par, par) for par in pares]
+            tareas += [(procesar_individual, item) for item in archivos_otros]
+
+            total_tareas = len(tareas)
+            resultados = [None] * total_tareas
+            completadas = 0
+
+            # Tandas grandes van por la Message Batches API (50% del costo
+            # por token y sin pelear límites de concurrencia). El resto del
+            # procesamiento (firmas, sello violeta, evaluación) corre igual
+            # en el pool local, con el análisis de Claude ya resuelto.
+            analisis_previos = {}
+            if total_tareas >= UMBRAL_LOTE_BATCHES:
+                # Clave de memo por tarea: los hits salen del memo sin tocar
+                # la API y solo los misses viajan en el lote. Los resultados
+                # del lote se guardan en el mismo memo, así re-analizar la
+                # misma tanda no vuelve a pagar el batch.
+                claves_tareas = {}
+                trabajos = {}
+                for i, (funcion, argumento) in enumerate(tareas):
+                    if funcion is procesar_par:
+                        claves_tareas[i] = (_clave_pdf(argumento["if"]["bytes"])
+                                            + _clave_pdf(argumento["ce"]["bytes"]))
+                    else:
+                        claves_tareas[i] = _clave_pdf(argumento["bytes"])
+
+                    previo = _analisis_cacheado(claves_tareas[i])
+                    if previo is not None:
+                        analisis_previos[i] = previo
+                    elif funcion is procesar_par:
+                        trabajos[str(i)] = _params_analisis_par(
+                            argumento["if"]["bytes"], argumento["ce"]["bytes"],
+                            argumento["if"]["nombre"], argumento["ce"]["nombre"]
+                        )
+                    else:
+                        trabajos[str(i)] = _params_analisis_individual(argumento["bytes"])
+
+                if trabajos:
+                    estado_texto.text(f"Enviando lote de {len(trabajos)} documento(s) a la Batches API...")
+                    try:
+                        lote_resultados = analizar_lote_claude(
+                            trabajos,
+                            al_progresar=lambda lote: estado_texto.text(
+                                f"Lote en proceso: "
+                                f"{lote.request_counts.succeeded + lote.request_counts.errored} "
+                                f"de {len(trabajos)} documento(s) resueltos..."
+                            ),
+                        )
+                    except Exception as e:
+                        # Si el lote entero falla (red, API caída durante el
+                        # sondeo), la corrida no se pierde: los ítems quedan
+                        # sin análisis previo y el pool los resuelve con
+                        # llamadas sincrónicas por documento.
+                        st.warning(f"Batches API no disponible ({e}). Se analiza documento por documento.")
+                        lote_resultados = {}
+
+                    # Ítems ausentes del lote (p. ej. expirados) quedan en
+                    # None y el procesador cae a la llamada sincrónica.
+                    for cid, res in lote_resultados.items():
+                        analisis_previos[int(cid)] = res
+                        if not isinstance(res, Exception):
+                            _guardar_analisis(claves_tareas[int(cid)], res)
+
+            estado_texto.text(f"Analizando {total_tareas} documento(s) en paralelo...")
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS_ANALISIS) as pool:
+                futuros = {
+                    pool.submit(funcion, argumento, analisis_previos.get(i)): i
+                    for i, (funcion, argumento) in enumerate(tareas)
+                }
+                # Cada update de la barra es un ForwardMsg por el websocket;
+                # con muchas tareas terminando juntas conviene espaciarlos
+                # (~20/seg alcanza para que se vea fluido).
+                ultimo_update = 0.0
+                for futuro in as_completed(futuros):
+                    resultados[futuros[futuro]] = futuro.result()
+                    completadas += 1
+                    ahora = time.monotonic()
+                    if ahora - ultimo_update > 0.05 or completadas == total_tareas:
+                        barra.progress(completadas / total_tareas if total_tareas else 1.0)
+                        estado_texto.text(f"Analizados {completadas} de {total_tareas} documento(s)...")
+                        ultimo_update = ahora
 
             barra.progress(1.0)
             estado_texto.text("✓ Análisis completado.")
 
-            # Resumen de pares detectados
-            if pares:
-                st.success(f"{len(pares)} par(es) IF+CE vinculados correctamente.")
-
-            df = pd.DataFrame(resultados)
-
-            # ── MÉTRICAS ─────────────────────────────────────────────────────
-            st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
-            total = len(df)
-            ok = len(df[df["Estado"].str.contains("OK", na=False)])
-            revisar = len(df[df["Estado"].str.contains("REVISAR", na=False)])
-            rechazar = len(df[df["Estado"].str.contains("RECHAZAR", na=False)])
-
-            col1, col2, col3, col4 = st.columns(4)
-            col1.metric("Total analizados", total)
-            col2.metric("Aprobados", ok)
-            col3.metric("A revisar", revisar)
-            col4.metric("Rechazados", rechazar)
-            st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
-
-            # ── TABLA ─────────────────────────────────────────────────────────
-            st.markdown('<p class="results-label">Resultados detallados</p>', unsafe_allow_html=True)
-
-            def colorear_filas(row):
-                estado = str(row.get("Estado", ""))
-                if "OK" in estado:
-                    color = "background-color: rgba(52,199,89,0.08); color: #E0E0E0;"
-                elif "REVISAR" in estado:
-                    color = "background-color: rgba(255,159,10,0.08); color: #E0E0E0;"
-                elif "RECHAZAR" in estado:
-                    color = "background-color: rgba(255,69,58,0.08); color: #E0E0E0;"
-                else:
-                    color = "color: #E0E0E0;"
-                return [color] * len(row)
-
-            def colorear_celda_estado(val):
-                val = str(val)
-                if "OK" in val:
-                    return "color: #34C759; font-weight: 600;"
-                elif "REVISAR" in val:
-                    return "color: #FF9F0A; font-weight: 600;"
-                elif "RECHAZAR" in val:
-                    return "color: #FF453A; font-weight: 600;"
-                return ""
-
-            df_styled = (
-                df.style
-                .apply(colorear_filas, axis=1)
-                .map(colorear_celda_estado, subset=["Estado"])
+            # Guardar en session_state: el click en "Descargar Excel"
+            # dispara un rerun con el botón "Analizar" en False; sin esto
+            # los resultados desaparecían y había que re-analizar todo.
+            # Construcción columnar con esquema fijo: más barata que dejar
+            # que pandas infiera columnas de una lista de dicts, y los dos
+            # campos repetitivos van como category para achicar el frame.
+            resultados.extend(filas_sin_claude)
+            resultados.extend(filas_duplicadas)
+            df_resultado = pd.DataFrame(
+                {c: [fila[c] for fila in resultados] for c in _COLUMNAS_RESULTADO},
+                columns=_COLUMNAS_RESULTADO,
             )
+            for _c in ("Tipo trámite", "Estado"):
+                df_resultado[_c] = df_resultado[_c].astype("category")
+
+            st.session_state["resultado_df"] = df_resultado
+            st.session_state["resultado_pares"] = len(pares)
+
+            # Soltar las referencias a los bytes de los PDFs: solo el
+            # DataFrame sobrevive al rerun, el resto puede liberarse ya.
+            archivos_if.clear()
+            archivos_ce.clear()
+            archivos_otros.clear()
+            pares.clear()
+            tareas.clear()
+
+    # ── RESULTADOS (desde session_state, sobreviven a los reruns) ────────────
+    if "resultado_df" in st.session_state:
+        df = st.session_state["resultado_df"]
+
+        # Resumen de pares detectados
+        if st.session_state.get("resultado_pares"):
+            st.success(f"{st.session_state['resultado_pares']} par(es) IF+CE vinculados correctamente.")
+
+        # ── MÉTRICAS ─────────────────────────────────────────────────────
+        st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
+        # Las máscaras se calculan una sola vez y se reusan para las métricas
+        # y para el coloreado de filas (antes eran 3 escaneos + un callback
+        # por fila del Styler).
+        total = len(df)
+        estados = df["Estado"].astype(str)
+        mask_ok = estados.str.contains("OK", na=False)
+        mask_revisar = estados.str.contains("REVISAR", na=False)
+        mask_rechazar = estados.str.contains("RECHAZAR", na=False)
+        ok = int(mask_ok.sum())
+        revisar = int(mask_revisar.sum())
+        rechazar = int(mask_rechazar.sum())
+
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Total analizados", total)
+        col2.metric("Aprobados", ok)
+        col3.metric("A revisar", revisar)
+        col4.metric("Rechazados", rechazar)
+        st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
+
+        # ── TABLA ─────────────────────────────────────────────────────────
+        st.markdown('<p class="results-label">Resultados detallados</p>', unsafe_allow_html=True)
+
+        def colorear_filas(d):
+            # Estilado de todo el frame en un solo paso (axis=None) con las
+            # máscaras ya calculadas, en vez de un callback por fila.
+            estilos = pd.DataFrame("color: #E0E0E0;", index=d.index, columns=d.columns)
+            estilos.loc[mask_ok, :] = "background-color: rgba(52,199,89,0.08); color: #E0E0E0;"
+            estilos.loc[mask_revisar, :] = "background-color: rgba(255,159,10,0.08); color: #E0E0E0;"
+            estilos.loc[mask_rechazar, :] = "background-color: rgba(255,69,58,0.08); color: #E0E0E0;"
+            return estilos
+
+        def colorear_celda_estado(val):
+            val = str(val)
+            if "OK" in val:
+                return "color: #34C759; font-weight: 600;"
+            elif "REVISAR" in val:
+                return "color: #FF9F0A; font-weight: 600;"
+            elif "RECHAZAR" in val:
+                return "color: #FF453A; font-weight: 600;"
+            return ""
+
+        df_styled = (
+            df.style
+            .apply(colorear_filas, axis=None)
+            .map(colorear_celda_estado, subset=["Estado"])
+        )
 
-            st.dataframe(df_styled, use_container_width=True)
+        st.dataframe(df_styled, use_container_width=True)
 
-            st.markdown('<div style="margin-top:1rem;"></div>', unsafe_allow_html=True)
-            st.download_button(
-                label="Descargar Excel",
-                data=generar_excel(df),
-                file_name="revision_apostillas.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+        st.markdown('<div style="margin-top:1rem;"></div>', unsafe_allow_html=True)
+        st.download_button(
+            label="Descargar Excel",
+            data=generar_excel(df),
+            file_name="revision_apostillas.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
 
 
 st.markdown('<div class="footer">Revisor de Apostillas · Automatización documental con IA · Leandro Spinelli · 2026 · v4.0</div>', unsafe_allow_html=True)
\ No newline at end of file